@@ -6,10 +6,15 @@
 #
 
 import unittest
+from unittest import mock
 import sys
+import os
 import re
+import tempfile
 
-from updateHosts import get_bad_lines, clean_data, patterns, restore_org_le
+from updateHosts import get_bad_lines, clean_data, patterns, restore_org_le, scan_hosts, process_data, read_hosts_date, get_hosts_file, read_hosts_file, allow_sites
+# module, target of mock.patch.object()
+import updateHosts
 
 __version__ = '1.0'
 
@@ -21,6 +26,31 @@ if not PY37:
    raise Exception('Python 3.7 or later required.')
 
 
+class FakeResponse:
+   """Streamed response returned by a stubbed session.get()."""
+
+   def __init__(self, lines, status_code=200):
+      self.lines = lines
+      self.status_code = status_code
+      self.encoding = 'utf-8'
+      # number of lines read from the stream
+      self.read = 0
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      return False
+
+   def raise_for_status(self):
+      pass
+
+   def iter_lines(self, chunk_size=512, decode_unicode=False):
+      for line in self.lines:
+         self.read += 1
+         yield line
+
+
 class Tests(unittest.TestCase):
 
    @classmethod
@@ -165,5 +195,161 @@ class Tests(unittest.TestCase):
       restore_org_le(self.data)
       self.assertEqual(self.data, self.restored_data)
 
+
+   def test_5_process_data(self):
+
+      print("\n---------- test_process_data():")
+
+      # all bad lines removed: the number of unique domains is updated
+      data = [
+              '# Number of unique domains: 003',
+              '',
+              '0.0.0.0 bad-8',
+              '0.0.0.0 good-1.com',
+              '',
+              '# site1.com',
+              '0.0.0.0 a.site1.com',
+              '0.0.0.0 b.site1.com',
+              '',
+              '0.0.0.0 good-2.com'
+             ]
+
+      bad_data = scan_hosts(data).bad_data
+      process_data(data, bad_data, ['site1.com'])
+      self.assertEqual(bad_data, [])
+      self.assertEqual(data, [
+                              '# Number of unique domains: 2',
+                              '',
+                              '0.0.0.0 good-1.com',
+                              '',
+                              '0.0.0.0 good-2.com'
+                             ])
+
+
+   def write_temp(self, text):
+      # temporary file removed at the end of the test
+      fd, path = tempfile.mkstemp(text=True)
+      with os.fdopen(fd, "w", encoding="utf-8") as f:
+         f.write(text)
+      self.addCleanup(os.remove, path)
+      return path
+
+
+   def test_6_read_hosts_date_no_date(self):
+
+      print("\n---------- test_read_hosts_date_no_date():")
+
+      # original system hosts: no date line
+      path = self.write_temp('127.0.0.1 localhost localhost.localdomain\n'
+                             '::1 localhost localhost.localdomain\n')
+      self.assertIsNone(read_hosts_date(path))
+
+
+   def test_7_read_hosts_date(self):
+
+      print("\n---------- test_read_hosts_date():")
+
+      date = '# Date: 14 October 2026 01:02:03 (UTC)'
+
+      # date line in the header
+      path = self.write_temp(f'# Title\n{date}\n0.0.0.0 a.com\n')
+      self.assertEqual(read_hosts_date(path), '261014')
+
+      # date line cut at size: the cut line is not parsed ('14 October 20')
+      # and the date is read from the whole file
+      header = f'# Title\n{date}\n'
+      path = self.write_temp(header + '0.0.0.0 a.com\n')
+      self.assertEqual(read_hosts_date(path, header.index('26 01')), '261014')
+
+      # date line after the header: read from the whole file
+      path = self.write_temp('# padding\n' * 300 + f'{date}\n')
+      self.assertEqual(read_hosts_date(path), '261014')
+
+
+   def test_8_get_hosts_file(self):
+
+      print("\n---------- test_get_hosts_file():")
+
+      lines = [
+               '# Title',
+               '# Date: 14 October 2026 01:02:03 (UTC)',
+               '',
+               '0.0.0.0 a.com',
+               '0.0.0.0 b.com'
+              ]
+      url = 'https://example.com/hosts'
+
+      def get(response):
+         return mock.patch.object(updateHosts.session, 'get', return_value=response)
+
+      # no date: full download
+      r = FakeResponse(lines)
+      with get(r) as g:
+         self.assertEqual(get_hosts_file(url), lines)
+      self.assertNotIn('If-Modified-Since', g.call_args.kwargs['headers'])
+
+      # not modified on the server
+      r = FakeResponse([], status_code=304)
+      with get(r) as g:
+         self.assertIsNone(get_hosts_file(url, '261014'))
+      self.assertEqual(g.call_args.kwargs['headers']['If-Modified-Since'],
+                       'Wed, 14 Oct 2026 00:00:00 GMT')
+
+      # not newer: stop at the date line
+      r = FakeResponse(lines)
+      with get(r):
+         self.assertIsNone(get_hosts_file(url, '261014'))
+      self.assertEqual(r.read, 2)
+
+      # newer: full download
+      r = FakeResponse(lines)
+      with get(r):
+         self.assertEqual(get_hosts_file(url, '261013'), lines)
+      self.assertEqual(r.read, len(lines))
+
+
+   def test_9_allow_sites(self):
+
+      print("\n---------- test_allow_sites():")
+
+      data = [
+              '# site1.com',
+              '0.0.0.0 a.site1.com',
+              '',
+              '# site2.com',
+              '0.0.0.0 a.site2.com',
+              '0.0.0.0 b.site2.com',
+              '',
+              '# site3.com',
+              '0.0.0.0 a.site3.com',
+              '',
+              '# site4.com',
+              '0.0.0.0 a.site4.com'
+             ]
+
+      # site in the middle, site at the end of the data
+      # (no empty line after it) and absent site
+      allow_sites(data, ['site2.com', 'site4.com', 'site5.com'])
+      self.assertEqual(data, [
+                              '# site1.com',
+                              '0.0.0.0 a.site1.com',
+                              '',
+                              '# site3.com',
+                              '0.0.0.0 a.site3.com',
+                              ''
+                             ])
+
+
+   def test_10_read_hosts_file(self):
+
+      print("\n---------- test_read_hosts_file():")
+
+      # lines split as in the download (str.splitlines())
+      path = self.write_temp('0.0.0.0 a.com\f0.0.0.0 b.com\n'
+                             '0.0.0.0 c.com\v0.0.0.0 d.com\n')
+      self.assertEqual(read_hosts_file(path), ['0.0.0.0 a.com', '0.0.0.0 b.com',
+                                               '0.0.0.0 c.com', '0.0.0.0 d.com'])
+
+
 if __name__ == "__main__":
    unittest.main()
\ No newline at end of file
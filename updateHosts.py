@@ -25,9 +25,13 @@ __version__ = '1.1'
 import sys
 import os
 import subprocess
+import shutil
 import re
 import argparse
-from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Optional
+from datetime import datetime, timezone
+from email.utils import format_datetime
 
 import requests
 import dateutil.parser as dparser
@@ -62,6 +66,27 @@ extensions = {'f': 'fakenews', 'g': 'gambling', 'p': 'porn', 's': 'social'}
 # hosts urls
 urls = "https://raw.githubusercontent.com/StevenBlack/hosts/master/alternates/{extensions}/hosts"
 
+# HTTP session (reuses connections)
+session = requests.Session()
+
+# download timeout in seconds
+timeout = 30
+
+# hosts file header lines
+DATE_PREFIX = '# Date: '
+NUD_PREFIX = '# Number of unique domains: '
+
+# valid loopback entries: accepted names by address
+# (names are matched as prefixes of the rest of the line)
+VALID_LOOPBACK = {'127.0.0.1': ('localhost', 'localhost.localdomain', 'local'),
+                  '255.255.255.255': ('broadcasthost',),
+                  '::1': ('localhost', 'ip6-localhost', 'ip6-loopback'),
+                  'fe80::1%lo0': ('localhost',),
+                  'ff00::0': ('ip6-localnet', 'ip6-mcastprefix'),
+                  'ff02::1': ('ip6-allnodes',),
+                  'ff02::2': ('ip6-allrouters',),
+                  'ff02::3': ('ip6-allhosts',)}
+
 
 # command-line arguments
 parser = argparse.ArgumentParser(description=f"Update system hosts with hosts file from Steven Black GitHub repository")
@@ -75,6 +100,12 @@ def main():
    # get args
    args = parser.parse_args()
 
+   # get the date of the system hosts
+   # (None if it has no date line: always update)
+   ldate = None
+   if os.path.isfile(hosts):
+      ldate = read_hosts_date(hosts)
+
    # read data
    if args.file is None:
       # get extensions
@@ -83,53 +114,50 @@ def main():
       url = urls.format(extensions='-'.join(ext))
       # download latest unified hosts file with extensions
       print(f"# Reading data from: \n{url}")
-      data = get_hosts_file(url)
+      data = get_hosts_file(url, ldate)
+      if data is None:
+         print(f"{hosts} is up to date.\nNothing to do.")
+         exit(0)
    else:
       # read hosts file from disk
       print(f"# Reading data from: \n{args.file[0]}")
       data = read_hosts_file(args.file[0])
 
+   # scan hosts file
+   info = scan_hosts(data)
+
    # get hosts file date
-   hdate, pdate = get_hosts_date(data)
+   hdate, pdate = parse_hosts_date(info.pdate)
    print(pdate[2:])
 
    # check if hosts file is up to date
-   if os.path.isfile(hosts):
-      if hdate <= get_hosts_date(read_hosts_file(hosts))[0]:
+   if ldate is not None:
+      if hdate <= ldate:
          print(f"{hosts} is up to date.\nNothing to do.")
          exit(0)
    
-   # calculate the number of unique domains
-   nc = calculate_nud(data)
-   
-   # read the number of unique domains
-   nr, line = read_nud(data)
+   # calculated number of unique domains
+   nc = info.nud
    
    # print the number of unique domains
-   if line is None:
+   if info.nud_line is None:
       print(f'Number of unique domains: {nc:,.0f} (calculated)')
    else:
-      if nr != nc:
+      line = info.nud_line[2:]
+      if read_nud(info.nud_line) != nc:
          line += f' (calculated: {nc:,.0f})'
       print(line)
 
    # print the number of lines and size of hosts file
-   size = len("\n".join(data)+"\n")
+   size = sum(map(len, data)) + len(data)
    print(f"Number of lines: {len(data):,.0f}   size: {size:,.0f} bytes")
 
-	# allow sites (remove them from hosts)
-   if args.allow != None:
-      allow_sites(data, args.allow)
-	
-   # get non-valid hosts lines
-   bad_data = get_bad_lines(data)
+   # non-valid hosts lines
+   bad_data = info.bad_data
+   print_bad_lines(bad_data)
 
-   # remove non-valid hosts lines
-   if bad_data != []:
-      clean_data(data, bad_data)
-      # calculate and write the number of unique domains
-      nud = calculate_nud(data)
-      write_nud(data, nud)
+   # remove non-valid hosts lines and allowed sites
+   process_data(data, bad_data, args.allow)
    
    # save hosts file,
    # update system hosts and 
@@ -142,19 +170,26 @@ def main():
       path = os.path.join(f"{database}", f"{basename}-{hdate}")
       
       print(f"# Saving to {path}")
-      save_hosts("\n".join(data)+"\n", path)
+      save_hosts(data, path)
       
       # save to hosts-latest
+      # (copy the saved file rather than writing the lines again)
       print(f"# Saving to {hosts_latest}")
-      save_hosts("\n".join(data)+"\n", hosts_latest)
+      try:
+         shutil.copyfile(path, hosts_latest)
+      except OSError as e:
+         e.add_note(f">>> error copying {path} to {hosts_latest}")
+         raise
 
       # update system hosts
+      # (cp writes into the existing file: its mode, owner and
+      # SELinux context are kept)
       print(f"# Updating {hosts}")
       try:
          subprocess.run(SUDO + ['cp', hosts_latest, hosts], check=True)
       except subprocess.CalledProcessError as e:
          e.add_note(f">>> error updating {hosts} from {hosts_latest}")
-      raise
+         raise
 
       # flush the DNS cache
       print("# Restarting NetworkManager")
@@ -169,16 +204,66 @@ def main():
       print("Nothing done.")
 
 
-def get_hosts_file(url):
+def process_data(data, bad_data, sites=None):
+   """Remove non-valid hosts lines and allowed sites,
+   and update the number of unique domains if lines were removed.
+   Args:
+      data: hosts file lines as list of strings
+      bad_data: non-valid hosts lines as list of (index, line)
+      sites: (optional) allowed sites
+   """
+   # clean_data() keeps only the accepted lines in bad_data:
+   # test for bad lines before cleaning
+   cleaned = bad_data != []
+
+   # remove non-valid hosts lines
+   if cleaned:
+      clean_data(data, bad_data)
+
+   # allow sites (remove them from hosts)
+   if sites is not None:
+      allow_sites(data, sites)
+
+   # calculate and write the number of unique domains
+   if cleaned:
+      nud = calculate_nud(data)
+      write_nud(data, nud)
+
+
+def get_hosts_file(url, since=None):
    """Download latest hosts file.
    Args:
       url: url of the hosts file
+      since: (optional) date of the system hosts as 'yymmdd'
    Returns:
-      hosts file as list of strings
+      hosts file as list of strings,
+      or None if the hosts file is not newer than since
    """
+   headers = {}
+   if since is not None:
+      mdate = datetime.strptime(since, '%y%m%d').replace(tzinfo=timezone.utc)
+      headers['If-Modified-Since'] = format_datetime(mdate, usegmt=True)
    try:
-      r = requests.get(url)
-      return r.text.splitlines()
+      with session.get(url, stream=True, timeout=timeout, headers=headers) as r:
+         # not modified
+         if r.status_code == 304:
+            return None
+         r.raise_for_status()
+         # iter_lines() yields bytes when no charset is given
+         if r.encoding is None:
+            r.encoding = 'utf-8'
+         lines = r.iter_lines(chunk_size=1<<16, decode_unicode=True)
+         # read the header up to the date line
+         data = []
+         for line in lines:
+            data.append(line)
+            if line.startswith(DATE_PREFIX):
+               # stop before downloading the rest of the file
+               if since is not None and parse_hosts_date(line)[0] <= since:
+                  return None
+               break
+         data.extend(lines)
+         return data
    except requests.exceptions.RequestException as e:
       e.add_note(f">>> error retrieving data from {url}")
       raise
@@ -192,8 +277,13 @@ def read_hosts_file(file):
       hosts file as list of strings
    """
    try:
-      with open(file, "r") as f:
+      with open(file, "r", encoding="utf-8", buffering=1<<20) as f:
          try:
+            # hint the kernel to read ahead (Linux)
+            if hasattr(os, 'posix_fadvise'):
+               os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            # split lines as the download does (iter_lines() uses
+            # str.splitlines(), which also splits on '\f', '\v', ...)
             return f.read().splitlines()
          except OSError as e:
             e.add_note(f">>> error reading {file}")
@@ -203,14 +293,53 @@ def read_hosts_file(file):
       raise
 
 
-def get_hosts_date(data):
-   """Get the date of the hosts file.
+def read_hosts_date(file, size=2048):
+   """Read the date of the hosts file from its header.
+   Args:
+      file: hosts file
+      size: number of characters to read for the header
+   Returns:
+      fdate: the date as 'yymmdd', or None if the file has no date line
+   """
+   try:
+      with open(file, "r", encoding="utf-8") as f:
+         header = f.read(size)
+   except (PermissionError, OSError) as e:
+      e.add_note(f">>> error reading {file}")
+      raise
+   # the last line may be cut at size
+   lines = header.splitlines()
+   if len(header) == size:
+      del lines[-1:]
+   pdate = get_date_line(lines)
+   # date line not in the header: read the whole file
+   if pdate is None:
+      pdate = get_date_line(read_hosts_file(file))
+   # no date line (e.g. the original system hosts)
+   if pdate is None:
+      return None
+   return parse_hosts_date(pdate)[0]
+
+
+def get_date_line(data):
+   """Get the date line of the hosts file.
    Args:
       data: hosts file lines as list of strings
+   Returns:
+      pdate: the date line, or None if not found
    """
 
-   prog = re.compile('^# Date: .+$')
-   pdate = next((s for s in data if prog.search(s)), None)
+   return next((s for s in data if s.startswith(DATE_PREFIX)), None)
+
+
+def parse_hosts_date(pdate):
+   """Parse the date line of the hosts file.
+   Args:
+      pdate: date line of the hosts file
+   Returns:
+      fdate: the date as 'yymmdd'
+      pdate: the date line
+   """
    if pdate is None:
       raise ValueError(">>> could not read date from hosts file")
       
@@ -226,29 +355,88 @@ def calculate_nud(data):
    Returns:
       nud: the number of unique domains
    """
-   prog = re.compile(patterns('hl'))
-   nud = sum(1 for line in data if prog.search(line))
+   nud = sum(map(is_domain_line, data))
    return nud
-   
-   
-def read_nud(data):
-   """Read the number of unique domains indicated in the host file.
+
+
+def is_domain_line(line):
+   """Test for a hosts line counted as a unique domain.
+   Args:
+      line: hosts file line
+   Returns:
+      True for a '0.0.0.0 <host>' line, except '0.0.0.0 0.0.0.0'
+   """
+   return (line.startswith('0.0.0.0 ') and len(line) > 8 and line[8] != '#'
+           and line != '0.0.0.0 0.0.0.0')
+   
+   
+@dataclass
+class HostsInfo:
+   """Information collected in a single pass over the hosts file.
+   Attributes:
+      pdate: date line, or None if not found
+      nud_line: line with the number of unique domains, or None if not found
+      nud: calculated number of unique domains
+      bad_data: non-valid hosts lines as list of (index, line)
+   """
+   pdate: Optional[str] = None
+   nud_line: Optional[str] = None
+   nud: int = 0
+   bad_data: list = field(default_factory=list)
+
+
+def scan_hosts(data):
+   """Get the date line, the line with the number of unique domains,
+   calculate the number of unique domains and get non-valid hosts lines
+   in a single pass.
    Args:
       data: hosts file lines as list of strings
+   Returns:
+      info: HostsInfo
+   """
+   prog = PATTERNS['h']
+   info = HostsInfo()
+   bad_data = info.bad_data
+   for i, line in enumerate(data):
+      # '0.0.0.0' hosts line, by far the most common: test it first
+      if line.startswith('0.0.0.0 '):
+         # count hosts lines, except '0.0.0.0 0.0.0.0'
+         if is_domain_line(line):
+            info.nud += 1
+         # verify the host
+         # (lines shorter than 264 characters are within the host limits)
+         valid = ((len(line) < 264 or check_host_limits(line))
+                  and prog.match(line, 8))
+      else:
+         # header lines
+         if info.pdate is None and line.startswith(DATE_PREFIX):
+            info.pdate = line
+         elif info.nud_line is None and line.startswith(NUD_PREFIX):
+            info.nud_line = line
+         # empty line, loopback entry or comment
+         valid = (not line or is_loopback(line)
+                  or line.lstrip(' \t').startswith('#'))
+      # non-valid line or line breaks injected into a line
+      if (not valid or '\n' in line or '\r' in line
+            or '\f' in line or '\v' in line):
+         bad_data.append((i, line))
+   return info
+
+
+def read_nud(line):
+   """Read the number of unique domains indicated in the host file.
+   Args:
+      line: line with the number of unique domains
    Returns:
       nud: the number of unique domains
-      line: the full text line
    """
    
-   prog = re.compile(patterns('nud'))
-   line = next((s for s in data if prog.search(s)), None)
-   
-   if line is not None:
-      nud = int(re.sub(",", "", prog.search(line).group(1)))
-   else:
+   try:
+      nud = int(line[len(NUD_PREFIX):].replace(",", ""))
+   except ValueError:
       nud = None
       
-   return nud, line[2:]
+   return nud
       
 
 def write_nud(data, nud):
@@ -258,36 +446,38 @@ def write_nud(data, nud):
       nud: the number of unique domains
    """
 
-   prog = re.compile(patterns('nud'))
-   i, s = next(((i, s) for i, s in enumerate(data) if prog.search(s)), (None, None))
+   i = next((i for i, s in enumerate(data) if s.startswith(NUD_PREFIX)), None)
 
    if i is not None:
-      data[i] = re.sub(r' [0-9,]{3,7}$', rf' {nud:,.0f}', s)
+      data[i] = f'{NUD_PREFIX}{nud:,.0f}'
       print(data[i][2:])
    else:
       raise ValueError('line with number of unique domains not found')
 
 
 def allow_sites(data, sites):
-	"""remove domains for allowed sites
+   """remove domains for allowed sites
    Args:
       data: hosts file lines as list of strings
-   Returns:
       sites: allowed sites
    """
 
-	print("# Allowing sites:")
-	for site in sites:
-		s = '# ' + site
-		if s in data:
-			i = data.index(s)
-			j = i + 1
-			while data[j] != '':
-				j += 1
-			del data[i:j+1]
-			print(f"{j-i-1} domains removed for {site}")
-	
-	
+   print("# Allowing sites:")
+   for site in sites:
+      # list.index() searches in C, faster than a Python-level index
+      try:
+         i = data.index('# ' + site)
+      except ValueError:
+         continue
+      # remove the site lines up to the next empty line
+      try:
+         j = data.index('', i + 1)
+      except ValueError:
+         j = len(data)
+      del data[i:j+1]
+      print(f"{j-i-1} domains removed for {site}")
+
+
 def get_bad_lines(data):
    """Verify integrity of the hosts file
    Args:
@@ -297,8 +487,17 @@ def get_bad_lines(data):
    """
 
    # get compromised or non-valid hosts lines
-   prog = re.compile(patterns('xhl'))
-   bad_data = [(i, line) for i, line in enumerate(data) if prog.search(line)]
+   bad_data = scan_hosts(data).bad_data
+   print_bad_lines(bad_data)
+
+   return bad_data
+
+
+def print_bad_lines(bad_data):
+   """Print the result of the hosts file integrity verification
+   Args:
+      bad_data: non-valid hosts lines as list of strings
+   """
    
    print("# Verifying hosts file integrity: ", end="")
    
@@ -313,7 +512,17 @@ def get_bad_lines(data):
    else:
       print("OK.")
 
-   return bad_data
+
+def is_loopback(line):
+   """Check if the line is a valid loopback entry.
+   Args:
+      line: hosts line
+   Returns:
+      True if the line is a valid loopback entry
+   """
+   ip, _, name = line.partition(' ')
+   names = VALID_LOOPBACK.get(ip)
+   return names is not None and name.startswith(names)
 
 
 def clean_data(data, bad_data):
@@ -326,19 +535,25 @@ def clean_data(data, bad_data):
    print("# Cleaning data:")
    
    # accepted hosts line: keep subdomains with '_'
-   prog = re.compile(patterns('ahl'))
+   prog = PATTERNS['h2']
    
-   # remove lines
-   nr = 0
-   for j in reversed(range(len(bad_data))):
-      i, line = bad_data[j]
-      if not prog.search(line):
-         del data[i]
-         del bad_data[j]
-         nr += 1
+   # sort bad lines into removed and kept lines
+   removed = []
+   kept = []
+   for i, line in bad_data:
+      if (line.startswith('0.0.0.0 ') and '\n' not in line
+            and check_host_limits(line) and prog.match(line, 8)):
+         kept.append((i, line))
+      else:
+         removed.append((i, line))
          print(f"Removed line {i}: {line}")
+
+   # remove lines in a single pass
+   ri = {i for i, _ in removed}
+   data[:] = [line for i, line in enumerate(data) if i not in ri]
+   bad_data[:] = kept
    
-   print(f"Removed {nr} lines.")
+   print(f"Removed {len(removed)} lines.")
    
    # print kept lines
    print(f"Kept {len(bad_data)} lines:")
@@ -350,18 +565,43 @@ def clean_data(data, bad_data):
    return
 
 
+def check_host_limits(line):
+   """Check the length limits on the host of a '0.0.0.0' hosts line:
+   less than 256 characters and less than 127 dots.
+   Args:
+      line: hosts line
+   Returns:
+      True if the host is within limits
+   """
+   end = line.find(' ', 8)
+   if end < 0:
+      end = len(line)
+   return end - 8 < 256 and line.count('.', 8, end) < 127
+
+
 def restore_org_le(data):
    """Restore loopback entries of the original Fedora hosts file
    Args:
       data: hosts file lines as list of strings
    """
-   i = data.index('127.0.0.1 localhost')
-   data[i] = '127.0.0.1 localhost localhost.localdomain localhost4 localhost4.localdomain4'
-   
-   data.remove('127.0.0.1 localhost.localdomain')
-   
-   i = data.index('::1 localhost')
-   data[i] = '::1 localhost localhost.localdomain localhost6 localhost6.localdomain6'
+   # locate the loopback entries in a single scan
+   # (they are at the top of the hosts file)
+   i4 = j = i6 = None
+   for k, line in enumerate(data):
+      if i4 is None and line == '127.0.0.1 localhost':
+         i4 = k
+      elif j is None and line == '127.0.0.1 localhost.localdomain':
+         j = k
+      elif i6 is None and line == '::1 localhost':
+         i6 = k
+      if i4 is not None and j is not None and i6 is not None:
+         break
+   else:
+      raise ValueError('loopback entries not found')
+
+   data[i4] = '127.0.0.1 localhost localhost.localdomain localhost4 localhost4.localdomain4'
+   data[i6] = '::1 localhost localhost.localdomain localhost6 localhost6.localdomain6'
+   del data[j]
    
    return
    
@@ -374,9 +614,9 @@ def save_hosts(data, path):
    """
    
    try:
-      with open(path, "w") as f:
+      with open(path, "w", encoding="utf-8", buffering=1<<20) as f:
          try:
-            f.write(data)
+            f.writelines(line + "\n" for line in data)
          except OSError as e:
             e.add_note(f">>> error writing to {path}")
             raise
@@ -393,14 +633,19 @@ def patterns(pattern):
          'd2':  domain2
          'ip4': ipv4
          'c':   comment
-         'xhl': non-valid hosts line
-         'ahl': accepted hosts line (subdomain with '_')
-         'hl':  hosts line
-         'nud': number of unique domains
-      str: string to scan
+         'h':   host of a '0.0.0.0' hosts line
+         'h2':  host of an accepted hosts line (subdomain with '_')
    Returns:
       regular expression pattern
    """
+   return PATTERN_STRINGS[pattern]
+
+
+def build_patterns():
+   """Build the regular expression patterns.
+   Returns:
+      dictionary of regex patterns
+   """
    
    # dictionary of regex patterns
    p = {}
@@ -414,16 +659,22 @@ def patterns(pattern):
    # https://www.rfc-editor.org/rfc/rfc3696#section-5
 
    # valid domain for a hosts file
-   domain = (r'(?![^ ]{256,})'
-             r'(?:(?!-)[a-z0-9-]{1,63}(?<!-)\.){1,126}'
-             r'(?![0-9]+( |\t|$))(?!-)[a-z0-9-]{2,63}(?<!-)')
+   # (labels start with an explicit non-hyphen character class
+   # rather than a '(?!-)' lookahead,
+   # length limits are checked by check_host_limits())
+   domain = (r'(?:[a-z0-9][a-z0-9-]{0,62}(?<!-)\.){1,126}'
+             r'(?![0-9]+( |\t|$))[a-z0-9][a-z0-9-]{1,62}(?<!-)')
    p['d'] = domain
    
    # valid subdomains with '_'
-   domain2 = (r'(?![^ ]{256,})(?!(?:.+?\.){127,})'
-              r'(?:(?!-)[a-z0-9-_]{1,63}(?<!-)\.){0,125}'
-              r'(?:(?!-)[a-z0-9-]{1,63}(?<!-)\.){1,126}'
-              r'(?![0-9]+( |\t|$))(?!-)[a-z0-9-]{2,63}(?<!-)')
+   # (the labels are matched once, in a lookahead, and consumed with a
+   # backreference, like an atomic group (?>...) on Python < 3.11:
+   # giving labels back cannot lead to a match when the domain is
+   # anchored, and trying every split of the labels between the two
+   # groups is quadratic on long bad lines)
+   domain2 = (r'(?=(?P<labels2>(?:[a-z0-9_][a-z0-9-_]{0,62}(?<!-)\.){0,125}'
+              r'(?:[a-z0-9][a-z0-9-]{0,62}(?<!-)\.){1,126}))(?P=labels2)'
+              r'(?![0-9]+( |\t|$))[a-z0-9][a-z0-9-]{1,62}(?<!-)')
    p['d2'] = domain2
    
    # valid ipv4 address
@@ -435,40 +686,22 @@ def patterns(pattern):
    comment = '[ \t]*#.*'
    p['c'] = comment
 
-   # non-valid hosts line
-   xhl = (rf'^(.*[\n\r\f\v\x0d\x0a\x0c\x0b].+|'
-          rf'(?!{comment})'
-          rf'(?!0\.0\.0\.0 (?:{domain}|{ipv4})(?:{comment})?)'
-           r'(?!127\.0\.0\.1 localhost)'
-           r'(?!127\.0\.0\.1 localhost\.localdomain)'
-           r'(?!127\.0\.0\.1 local)'
-           r'(?!255\.255\.255\.255 broadcasthost)'
-           r'(?!::1 localhost)'
-           r'(?!::1 ip6-localhost)'
-           r'(?!::1 ip6-loopback)'
-           r'(?!fe80::1%lo0 localhost)'
-           r'(?!ff00::0 ip6-localnet)'
-           r'(?!ff00::0 ip6-mcastprefix)'
-           r'(?!ff02::1 ip6-allnodes)'
-           r'(?!ff02::2 ip6-allrouters)'
-           r'(?!ff02::3 ip6-allhosts)'
-           r'.+)$'
-         )
-   p['xhl'] = xhl
-   
-   # accepted hosts line: keep subdomains with '_'
-   ahl = rf'^0\.0\.0\.0 ({domain2}|{ipv4})({comment})?$'
-   p['ahl'] = ahl
+   # valid host of a '0.0.0.0' hosts line: domain or ipv4
+   host = rf'(?:{domain}|{ipv4})'
+   p['h'] = host
    
-   # hosts line
-   hl = r'^0\.0\.0\.0 (?!0\.0\.0\.0$)(?:[^#]+\.)*[^#]+.*$'
-   p['hl'] = hl
-   
-   # number of unique domains
-   nud = r'^# Number of unique domains: ([0-9,]{3,7})$'
-   p['nud'] = nud
+   # host of an accepted hosts line: keep subdomains with '_'
+   # (followed by a comment or the end of the line)
+   host2 = rf'(?:{domain2}|{ipv4})(?:[ \t]*#|$)'
+   p['h2'] = host2
+
+   return p
+
 
-   return p[pattern]
+# regular expression patterns and compiled regular expressions,
+# built once at import
+PATTERN_STRINGS = build_patterns()
+PATTERNS = {k: re.compile(v) for k, v in PATTERN_STRINGS.items()}
    
    
 if __name__ == "__main__":